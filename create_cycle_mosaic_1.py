@@ -10,8 +10,8 @@ from itertools import cycle
 
 from utils.timers import Square_Wave_Timer
 from utils.video_recorder import Video_Recorder
-from utils.frame_makers import make_blank_frame, make_noise3ch_frame, make_blurred_noise3ch_frame, make_color_frame, \
-                               add_gradient_noise
+from utils.frame_makers import make_blank_frame, make_noise3ch_frame, make_blurred_gray_noise_frame, make_color_frame, \
+                               make_text_frame, draw_sprite, add_gradient_noise
 
 #%% Parse script args
 
@@ -22,8 +22,11 @@ ap = argparse.ArgumentParser(description="View/create station test pattern video
 default_length = 5
 default_output = "cycle_mosaic_1.mp4"
 ap.add_argument("-r", "--record", action = "store_true", help = "Enable video recording")
-ap.add_argument("-c", "--codec", type = str, help = "Manually set the recorded video codec (e.g. 'avc1', 'XVID', 'MJPG')")
+ap.add_argument("-c", "--codec", type = str, help = "Manually set the recorded video codec (e.g. 'avc1', 'XVID', 'MJPG' or 'ffmpeg:libx264')")
+ap.add_argument("-b", "--backend", type = str, choices = ["cv2", "ffmpeg"], help = "Manually set the recording backend (default is to use ffmpeg, if available)")
 ap.add_argument("-l", "--length_mins", type = float, default = 5, help = "Recorded video length in minutes (default is {})".format(default_length))
+ap.add_argument("-n", "--no_preview", action = "store_true", help = "Disable the video preview window (e.g. for faster recording)")
+ap.add_argument("-j", "--numba", action = "store_true", help = "Use compiled (numba) noise generation, requires numba")
 ap.add_argument("-o", "--output", type = str, default = "cycle_mosaic_1.mp4", help = "Output save path/name (default is '{}')".format(default_output))
 
 # Execute the parse_args() method
@@ -32,8 +35,15 @@ ap_result = ap.parse_args()
 # For convenience
 ARG_ENABLE_RECORD = ap_result.record
 ARG_CODEC = ap_result.codec
+ARG_BACKEND = ap_result.backend
 ARG_LENGTH_MINS = ap_result.length_mins
 ARG_OUTPUT = ap_result.output
+ARG_NO_PREVIEW = ap_result.no_preview
+ARG_USE_NUMBA = ap_result.numba
+
+# Swap in the numba version of the gradient noise if needed (numba is an optional dependency, so import only if used)
+if ARG_USE_NUMBA:
+    from utils.frame_makers_numba import add_gradient_noise
 
 
 #%% Output config
@@ -46,7 +56,7 @@ video_fps = 30.0
 #%% Recording config
 
 # Set up video recording, in case recording is enabled
-vwrite = Video_Recorder(ARG_OUTPUT, video_fps, enabled = ARG_ENABLE_RECORD, codec = ARG_CODEC)
+vwrite = Video_Recorder(ARG_OUTPUT, video_fps, enabled = ARG_ENABLE_RECORD, codec = ARG_CODEC, backend = ARG_BACKEND)
 
 # Some user feedback
 if ARG_ENABLE_RECORD:
@@ -88,11 +98,40 @@ text_15sec_low_contrast_config = {**text_15sec_config, **low_contrast_config}
 text_60sec_config = {**shared_font_config, **high_contrast_config, "text": "60s"}
 text_60sec_low_contrast_config = {**text_60sec_config, **low_contrast_config}
 
+# Pre-render text frames, since the text itself never changes (only whether it's shown or not)
+text_1s_hc_cached = make_text_frame(text_1sec_config, *text_wh)
+text_1s_lc_cached = make_text_frame(text_1sec_low_contrast_config, *text_wh)
+text_5s_hc_cached = make_text_frame(text_5sec_config, *text_wh)
+text_5s_lc_cached = make_text_frame(text_5sec_low_contrast_config, *text_wh)
+text_15s_hc_cached = make_text_frame(text_15sec_config, *text_wh)
+text_15s_lc_cached = make_text_frame(text_15sec_low_contrast_config, *text_wh)
+text_60s_hc_cached = make_text_frame(text_60sec_config, *text_wh)
+text_60s_lc_cached = make_text_frame(text_60sec_low_contrast_config, *text_wh)
+
+# Pre-build full text rows for every combination of shown/hidden text (bit 0 -> 1s text, bit 1 -> 5s text, etc.)
+hc_text_frames = (text_1s_hc_cached, text_5s_hc_cached, text_15s_hc_cached, text_60s_hc_cached)
+lc_text_frames = (text_1s_lc_cached, text_5s_lc_cached, text_15s_lc_cached, text_60s_lc_cached)
+hc_text_strips = []
+lc_text_strips = []
+for text_mask in range(2 ** len(hc_text_frames)):
+    text_is_shown = [bool(text_mask & (1 << idx)) for idx in range(len(hc_text_frames))]
+    hc_text_strips.append(np.hstack([each_frame if each_is_shown else text_blank
+                                     for each_frame, each_is_shown in zip(hc_text_frames, text_is_shown)]))
+    lc_text_strips.append(np.hstack([each_frame if each_is_shown else text_blank
+                                     for each_frame, each_is_shown in zip(lc_text_frames, text_is_shown)]))
+
+# Pre-scale (to 10% brightness) the high contrast text rows, which get blended into the continuous noise
+faint_text_lut = np.uint8(np.round(np.arange(256) * 0.1))
+faint_text_strips = [cv2.LUT(each_strip, faint_text_lut) for each_strip in hc_text_strips]
+
+# Make sure the pre-built text rows are never modified, since they're copied into every frame (even when blank)
+for each_strip in (*hc_text_strips, *lc_text_strips, *faint_text_strips):
+    each_strip.setflags(write = False)
+
 # Continuous noise config
 cont_noise_width = frame_width
 cont_noise_height = 50
 cont_noise_wh = (cont_noise_width, cont_noise_height)
-continuous_noise = make_noise3ch_frame(*cont_noise_wh)
 
 # Blinking noise config
 blink_noise_width = frame_width
@@ -107,7 +146,8 @@ fast_scroll_x_idx = np.linspace(0, 1, frame_width)#np.arange(fast_scroll_width)
 fast_scroll_one_row = 255 * (np.sin(2*np.pi*fast_scroll_x_idx/np.linspace(0.01, 0.05, frame_width)) > 0)
 fast_scroll_bar = np.rollaxis(np.tile(fast_scroll_one_row, (3, fast_scroll_height, 1)), 2, 1).T
 fast_scroll_bar = np.uint8(fast_scroll_bar)
-fast_scroll_noisy = add_gradient_noise(fast_scroll_bar)
+fast_scroll_bar_x2 = np.hstack((fast_scroll_bar, fast_scroll_bar))
+fast_scroll_offset = 0
 
 # Create medium scrolling pattern
 medium_scroll_width = frame_width
@@ -116,7 +156,8 @@ medium_scroll_x_idx = np.arange(medium_scroll_width)
 medium_scroll_one_row = 255 * (np.sin(2*np.pi*fast_scroll_x_idx/np.linspace(0.02, 0.1, frame_width)) > 0)
 medium_scroll_bar = np.rollaxis(np.tile(medium_scroll_one_row, (3, medium_scroll_height, 1)), 2, 1).T
 medium_scroll_bar = np.uint8(medium_scroll_bar)
-medium_scroll_noisy = add_gradient_noise(medium_scroll_bar)
+medium_scroll_bar_x2 = np.hstack((medium_scroll_bar, medium_scroll_bar))
+medium_scroll_offset = 0
 
 # Create slow scrolling pattern
 slow_scroll_width = frame_width
@@ -125,13 +166,13 @@ slow_scroll_x_idx = np.arange(slow_scroll_width)
 slow_scroll_one_row = 255 * (np.sin(2*np.pi*fast_scroll_x_idx/np.linspace(0.05, 0.2, frame_width)) > 0)
 slow_scroll_bar = np.rollaxis(np.tile(slow_scroll_one_row, (3, slow_scroll_height, 1)), 2, 1).T
 slow_scroll_bar = np.uint8(slow_scroll_bar)
-slow_scroll_noisy = add_gradient_noise(slow_scroll_bar)
+slow_scroll_bar_x2 = np.hstack((slow_scroll_bar, slow_scroll_bar))
+slow_scroll_offset = 0
 
-# Create blank starter frame for figure-8 circle pattern
+# Config for figure-8 circle pattern
 fig8_width = frame_width
 fig8_height = 50
 fig8_half_height = int(fig8_height / 2)
-figure_8_circle_blank = make_blank_frame(fig8_width, fig8_height)
 
 # Define figure-8 helpers
 circle_rad = 6
@@ -142,6 +183,12 @@ sin01 = lambda t, freq: (1 + np.sin(twopi * t * freq)) / 2
 get_circle_x = lambda t: int(circle_rad + (fig8_width - (2 * circle_rad)) * sin01(t, x_freq))
 get_circle_y = lambda t: int(circle_rad + (fig8_height - (2 * circle_rad)) * sin01(t, y_freq))
 
+# Pre-draw the circle (with a 1px margin for anti-aliasing), so it only needs to be copied into place each frame
+circle_sprite_offset = circle_rad + 1
+circle_sprite_size = 1 + 2 * circle_sprite_offset
+circle_sprite = make_blank_frame(circle_sprite_size, circle_sprite_size)
+cv2.circle(circle_sprite, (circle_sprite_offset, circle_sprite_offset), circle_rad, (255, 255, 255), -1, cv2.LINE_AA)
+
 # Create color cycling pattern
 color_width = int(frame_width / 4)
 color_height = 50
@@ -156,10 +203,44 @@ saturation_frame = make_color_frame(next(saturation_bgrs), *color_wh)
 brightness_frame = make_color_frame(next(brightness_bgrs), *color_wh)
 
 
+#%% Set up display frames
+
+# Define the height of each row of patterns in the display (from top-to-bottom)
+display_row_heights = (text_height, text_height, fig8_height,
+                       fast_scroll_height, medium_scroll_height, slow_scroll_height,
+                       color_height, blink_noise_height, cont_noise_height)
+display_row_starts = np.cumsum((0, *display_row_heights))
+display_shape = (display_row_starts[-1], frame_width, 3)
+
+def get_display_views(display_frame):
+    
+    ''' Helper used to split a display frame into (row) views, which each pattern is drawn directly into '''
+    
+    hc_row, lc_row, figure_8_row, fast_scroll_row, medium_scroll_row, slow_scroll_row, color_row, blink_row, cont_row = \
+        [display_frame[y1:y2] for y1, y2 in zip(display_row_starts[:-1], display_row_starts[1:])]
+    figure_8_noisy_row = figure_8_row[fig8_half_height:]
+    
+    # Combined view of all (adjacent) scroll rows, so that noise can be added to all of them at once
+    scroll_rows = display_frame[display_row_starts[3]:display_row_starts[6]]
+    
+    # Split color row into separate (column) views for each tile
+    color_tiles = [color_row[:, (k * color_width):((k + 1) * color_width)] for k in range(4)]
+    
+    return (hc_row, lc_row, figure_8_row, figure_8_noisy_row,
+            scroll_rows, fast_scroll_row, medium_scroll_row, slow_scroll_row,
+            *color_tiles, blink_row, cont_row)
+
+# Display frames come from a small pool (owned by the recorder), so new frames can be drawn while older ones are
+# still being recorded. Each pooled frame is re-used, so we only need to split it into views once
+# -> Every row is fully re-drawn on every frame, so it doesn't matter what was previously drawn into a display frame
+display_views_lut = {}
+
+
 #%% Draw frames
 
 # Timer for handling periodic changes to image
-timer = Square_Wave_Timer()
+timer = Square_Wave_Timer(video_fps)
+timer.register(0.25, 0.5, 1, 2, 4, 5, 8, 15, 60)
 
 # *** Video loop ***
 total_frames = int(round(video_fps * ARG_LENGTH_MINS * 60))
@@ -167,56 +248,49 @@ for k in range(total_frames):
     
     # Update toggle timers
     curr_time_sec = k / video_fps
-    timer.update(curr_time_sec)
+    timer.update(k)
     
-    # Draw blinking text
-    text_1s_high_contrast = make_blank_frame(*text_wh)
-    text_1s_low_contrast = make_blank_frame(*text_wh)
-    if timer.is_high(1):
-        cv2.putText(text_1s_high_contrast, **text_1sec_config)
-        cv2.putText(text_1s_low_contrast, **text_1sec_low_contrast_config)
-        
-    text_5s_high_contrast = make_blank_frame(*text_wh)
-    text_5s_low_contrast = make_blank_frame(*text_wh)
-    if timer.is_high(5):
-        cv2.putText(text_5s_high_contrast, **text_5sec_config)
-        cv2.putText(text_5s_low_contrast, **text_5sec_low_contrast_config)
+    # Wait for a display frame to be available (i.e. finished recording) to draw into
+    display_frame = vwrite.acquire_frame(display_shape)
+    display_views = display_views_lut.get(id(display_frame), None)
+    if display_views is None:
+        display_views = get_display_views(display_frame)
+        display_views_lut[id(display_frame)] = display_views
+    hc_row, lc_row, figure_8_row, figure_8_noisy_row, \
+    scroll_rows, fast_scroll_row, medium_scroll_row, slow_scroll_row, \
+    color_row_1, color_row_2, color_row_3, color_row_4, blink_row, cont_row = display_views
     
-    text_15s_high_contrast = make_blank_frame(*text_wh)
-    text_15s_low_contrast = make_blank_frame(*text_wh)
-    if timer.is_high(15):
-        cv2.putText(text_15s_high_contrast, **text_15sec_config)
-        cv2.putText(text_15s_low_contrast, **text_15sec_low_contrast_config)
-    
-    text_60s_high_contrast = make_blank_frame(*text_wh)
-    text_60s_low_contrast = make_blank_frame(*text_wh)
-    if timer.is_high(60):
-        cv2.putText(text_60s_high_contrast, **text_60sec_config)
-        cv2.putText(text_60s_low_contrast, **text_60sec_low_contrast_config)
-    
-    # Draw all text combined in a single row
-    high_contrast_text = np.hstack([text_1s_high_contrast, text_5s_high_contrast, text_15s_high_contrast, text_60s_high_contrast])
-    low_contrast_text = np.hstack([text_1s_low_contrast, text_5s_low_contrast, text_15s_low_contrast, text_60s_low_contrast])
+    # Copy pre-built text rows, based on which of the blinking text is currently shown
+    text_mask = timer.is_high(1) | (timer.is_high(5) << 1) | (timer.is_high(15) << 2) | (timer.is_high(60) << 3)
+    np.copyto(hc_row, hc_text_strips[text_mask])
+    np.copyto(lc_row, lc_text_strips[text_mask])
     
     # Draw figure-8 circle
-    figure_8_circle = figure_8_circle_blank.copy()
-    circle_xy = (get_circle_x(curr_time_sec), get_circle_y(curr_time_sec))
-    cv2.circle(figure_8_circle, circle_xy, circle_rad, (255, 255, 255), -1, cv2.LINE_AA)
-    figure_8_circle[fig8_half_height:, :] = add_gradient_noise(figure_8_circle[fig8_half_height:, :])
+    figure_8_row.fill(0)
+    circle_x1 = get_circle_x(curr_time_sec) - circle_sprite_offset
+    circle_y1 = get_circle_y(curr_time_sec) - circle_sprite_offset
+    draw_sprite(figure_8_row, circle_sprite, (circle_x1, circle_y1))
+    add_gradient_noise(figure_8_noisy_row, out = figure_8_noisy_row)
     
-    # Update fast scrolling bar
-    fast_scroll_bar = np.roll(fast_scroll_bar, 1, axis = 1)
-    fast_scroll_noisy = add_gradient_noise(fast_scroll_bar)
+    # Update fast scrolling bar (sliding a view across the doubled-up bar is equivalent to rolling it)
+    fast_scroll_offset = (fast_scroll_offset - 1) % fast_scroll_width
+    fast_scroll_view = fast_scroll_bar_x2[:, fast_scroll_offset:(fast_scroll_offset + fast_scroll_width)]
+    np.copyto(fast_scroll_row, fast_scroll_view)
     
     # Update medium scrolling bar
     if timer.is_rising(0.25):
-        medium_scroll_bar = np.roll(medium_scroll_bar, 1, axis = 1)
-    medium_scroll_noisy = add_gradient_noise(medium_scroll_bar)
+        medium_scroll_offset = (medium_scroll_offset - 1) % medium_scroll_width
+    medium_scroll_view = medium_scroll_bar_x2[:, medium_scroll_offset:(medium_scroll_offset + medium_scroll_width)]
+    np.copyto(medium_scroll_row, medium_scroll_view)
     
     # Update slow scrolling bar
     if timer.is_rising(0.5):
-        slow_scroll_bar = np.roll(slow_scroll_bar, 1, axis = 1)
-    slow_scroll_noisy = add_gradient_noise(slow_scroll_bar)
+        slow_scroll_offset = (slow_scroll_offset - 1) % slow_scroll_width
+    slow_scroll_view = slow_scroll_bar_x2[:, slow_scroll_offset:(slow_scroll_offset + slow_scroll_width)]
+    np.copyto(slow_scroll_row, slow_scroll_view)
+    
+    # Add noise to all scroll bars together
+    add_gradient_noise(scroll_rows, out = scroll_rows)
     
     # Draw color cycling
     if timer.is_falling(4):
@@ -226,38 +300,29 @@ for k in range(total_frames):
         saturation_frame = make_color_frame(next(saturation_bgrs), *color_wh)    
     if timer.is_falling(1):
         brightness_frame = make_color_frame(next(brightness_bgrs), *color_wh)    
-    color_frames = (primary_frame, secondary_frame, saturation_frame, brightness_frame)
-    noisy_colors = [add_gradient_noise(frame) for frame in color_frames]
-    color_frames = np.hstack(noisy_colors)
+    add_gradient_noise(primary_frame, out = color_row_1)
+    add_gradient_noise(secondary_frame, out = color_row_2)
+    add_gradient_noise(saturation_frame, out = color_row_3)
+    add_gradient_noise(brightness_frame, out = color_row_4)
     
     # Update blink noise 
     if timer.is_falling(8):
-        blink_noise = make_noise3ch_frame(*blink_noise_wh)
+        make_noise3ch_frame(*blink_noise_wh, out = blink_noise)
+    np.copyto(blink_row, blink_noise)
         
     # Update continuouse noise every frame
-    continuous_noise = make_blurred_noise3ch_frame(*cont_noise_wh, 5)
-    continuous_noise = cv2.addWeighted(continuous_noise, 1.0, high_contrast_text, 0.1, 0)
-    
-    # Build final display by stacking rows of images
-    display_frame = np.vstack((
-            high_contrast_text,
-            low_contrast_text,
-            figure_8_circle,
-            fast_scroll_noisy,
-            medium_scroll_noisy,
-            slow_scroll_noisy,
-            color_frames,
-            blink_noise,
-            continuous_noise))
+    make_blurred_gray_noise_frame(*cont_noise_wh, 5, out = cont_row)
+    cv2.add(cont_row, faint_text_strips[text_mask], dst = cont_row)
     
-    # Show frame for reference
-    cv2.imshow("Display", display_frame)
-    keypress = cv2.waitKey(1)
-    if keypress == 27:
-        break
+    # Show frame for reference, unless the preview is disabled
+    if not ARG_NO_PREVIEW:
+        cv2.imshow("Display", display_frame)
+        keypress = cv2.waitKey(1)
+        if keypress == 27:
+            break
     
-    # Record if needed
-    vwrite.write(display_frame)
+    # Record if needed. The display frame is handed over without copying, and is made available again once written
+    vwrite.submit(display_frame)
 
 
 # Clean up
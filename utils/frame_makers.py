@@ -5,38 +5,131 @@
 import cv2
 import numpy as np
 
+from functools import lru_cache
+
 
 #%% Classes
 
 
+#%% Globals
+
+# Storage for gradient frames, keyed by (width, height), so they only need to be computed once
+_gradient_cache = {}
+
+# Storage for internal working frames, keyed by (name, shape), so they don't need to be re-allocated on every call
+_scratch_cache = {}
+
+
 #%% Functions
 
 def make_blank_frame(width, height):
     return np.zeros((height, width, 3), dtype = np.uint8)
 
-def make_noise3ch_frame(width, height):
-    return np.random.randint(0, 255, (height, width, 3), dtype = np.uint8)
+def make_noise3ch_frame(width, height, out = None):
+    if out is None:
+        out = np.empty((height, width, 3), dtype = np.uint8)
+    cv2.randu(out, (0, 0, 0), (255, 255, 255))
+    return out
 
-def make_blurred_noise3ch_frame(width, height, blurriness = 3):
+def make_blurred_noise3ch_frame(width, height, blurriness = 3, out = None):
     blur_kernel = (blurriness, blurriness)
-    return cv2.blur(make_noise3ch_frame(width, height), ksize = blur_kernel, borderType = cv2.BORDER_REFLECT)
+    noise_frame = make_noise3ch_frame(width, height, out = _get_scratch_frame("noise_3ch", (height, width, 3)))
+    return cv2.blur(noise_frame, ksize = blur_kernel, dst = out, borderType = cv2.BORDER_REFLECT)
+
+def make_blurred_gray_noise_frame(width, height, blurriness = 3, out = None):
+    
+    ''' Like make_blurred_noise3ch_frame, but only blurs a single channel of noise, which is copied to all 3 channels '''
+    
+    blur_kernel = (blurriness, blurriness)
+    raw_noise_1ch = _get_scratch_frame("gray_raw_noise_1ch", (height, width))
+    noise_1ch = _get_scratch_frame("gray_noise_1ch", (height, width))
+    cv2.randu(raw_noise_1ch, 0, 255)
+    cv2.blur(raw_noise_1ch, ksize = blur_kernel, dst = noise_1ch, borderType = cv2.BORDER_REFLECT)
+    
+    return cv2.cvtColor(noise_1ch, cv2.COLOR_GRAY2BGR, dst = out)
 
 def make_color_frame(color_bgr, width, height):
-    return np.full((height, width, 3), color_bgr, dtype = np.uint8)
+    
+    ''' Returns a (cached) solid color frame. The frame is read-only, since it may be shared with other callers! '''
+    
+    return _make_cached_color_frame(tuple(color_bgr), width, height)
+
+def make_text_frame(text_config, width, height):
+    text_frame = make_blank_frame(width, height)
+    cv2.putText(text_frame, **text_config)
+    return text_frame
+
+def draw_sprite(frame, sprite, top_left_xy):
+    
+    ''' Draws a (pre-rendered) sprite into the given frame, in-place, keeping the brighter of the two images '''
+    
+    frame_h, frame_w = frame.shape[0:2]
+    sprite_h, sprite_w = sprite.shape[0:2]
+    x1, y1 = top_left_xy
+    
+    # Clip the drawing region to the frame boundaries
+    fx1, fy1 = max(x1, 0), max(y1, 0)
+    fx2, fy2 = min(x1 + sprite_w, frame_w), min(y1 + sprite_h, frame_h)
+    if fx2 <= fx1 or fy2 <= fy1:
+        return frame
+    
+    frame_region = frame[fy1:fy2, fx1:fx2]
+    sprite_region = sprite[(fy1 - y1):(fy2 - y1), (fx1 - x1):(fx2 - x1)]
+    np.maximum(frame_region, sprite_region, out = frame_region)
+    
+    return frame
 
-def add_gradient_noise(frame):
+def add_gradient_noise(frame, out = None):
     
-    ''' Adds (blurred) grayscale noise that increases in intensity from left-to-right across the given frame '''
+    '''
+    Adds (blurred) grayscale noise that increases in intensity from left-to-right across the given frame
+    The result is written into 'out' if provided (which can be the input frame itself), otherwise a new frame is returned
+    '''
     
     frame_h, frame_w = frame.shape[0:2]
     
-    noise_frame = cv2.cvtColor(make_blurred_noise3ch_frame(frame_w, frame_h, 3), cv2.COLOR_BGR2GRAY)
-    gradient_1d = np.clip(np.linspace(-0.25, 1.25, frame_w), 0, 1)
-    gradient_2d = np.tile(gradient_1d, (frame_h, 1))
-    gradient_noise_frame = np.uint8(gradient_2d * noise_frame)
-    gradient_noise_frame = cv2.cvtColor(gradient_noise_frame, cv2.COLOR_GRAY2BGR)
+    # Get re-usable working frames, since the intermediate results aren't needed after this call
+    raw_noise_1ch = _get_scratch_frame("raw_noise_1ch", (frame_h, frame_w))
+    noise_1ch = _get_scratch_frame("noise_1ch", (frame_h, frame_w))
+    gradient_noise_1ch = _get_scratch_frame("gradient_noise_1ch", (frame_h, frame_w))
+    gradient_noise_frame = _get_scratch_frame("gradient_noise_3ch", (frame_h, frame_w, 3))
+    
+    # Scale single-channel noise by the (cached) gradient in one pass, then add it to every channel of the frame
+    cv2.randu(raw_noise_1ch, 0, 255)
+    cv2.blur(raw_noise_1ch, ksize = (3, 3), dst = noise_1ch, borderType = cv2.BORDER_REFLECT)
+    cv2.multiply(noise_1ch, _get_gradient_frame(frame_w, frame_h), dst = gradient_noise_1ch, scale = 1.0 / 255.0)
+    cv2.cvtColor(gradient_noise_1ch, cv2.COLOR_GRAY2BGR, dst = gradient_noise_frame)
+    
+    return cv2.add(frame, gradient_noise_frame, dst = out)
+
+def _get_gradient_frame(width, height):
+    
+    ''' Helper used to build (and cache) the left-to-right gradient (0-to-255) used by add_gradient_noise '''
+    
+    frame_wh = (width, height)
+    if frame_wh not in _gradient_cache:
+        gradient_1d = np.uint8(np.round(255 * np.clip(np.linspace(-0.25, 1.25, width), 0, 1)))
+        _gradient_cache[frame_wh] = np.tile(gradient_1d, (height, 1))
+    
+    return _gradient_cache[frame_wh]
+
+@lru_cache(maxsize = 64)
+def _make_cached_color_frame(color_bgr, width, height):
+    color_frame = np.full((height, width, 3), color_bgr, dtype = np.uint8)
+    color_frame.setflags(write = False)
+    return color_frame
+
+def _get_scratch_frame(name, shape):
+    
+    ''' Helper used to get (cached) uint8 working frames. These should never be returned to callers! '''
+    
+    cache_key = (name, shape)
+    scratch_frame = _scratch_cache.get(cache_key)
+    if scratch_frame is None:
+        scratch_frame = np.empty(shape, dtype = np.uint8)
+        _scratch_cache[cache_key] = scratch_frame
     
-    return cv2.add(frame, gradient_noise_frame)
+    return scratch_frame
 
 
 #%% Demo
@@ -51,6 +144,7 @@ if __name__ == "__main__":
             make_blank_frame(*example_wh),
             make_noise3ch_frame(*example_wh),
             make_blurred_noise3ch_frame(*example_wh),
+            make_blurred_gray_noise_frame(*example_wh),
             make_color_frame(red_bgr, *example_wh),
             add_gradient_noise(make_color_frame(blue_bgr, *example_wh))
     ]
@@ -0,0 +1,104 @@
+
+
+#%% Imports
+
+import numpy as np
+
+from numba import njit, prange
+
+from utils.frame_makers import _get_gradient_frame
+
+
+#%% Classes
+
+
+#%% Globals
+
+# Random number generator, only used to pick a new starting point for the noise (hash) inputs on each call
+_seed_rng = np.random.default_rng()
+
+
+#%% Functions
+
+def add_gradient_noise(frame, out = None):
+    
+    '''
+    Numba version of frame_makers.add_gradient_noise, which generates, blurs, scales & adds the noise
+    in a single compiled (multi-threaded) call. Takes the same inputs and gives (statistically) the same results
+    '''
+    
+    if out is None:
+        out = np.empty_like(frame)
+    
+    frame_h, frame_w = frame.shape[0:2]
+    gradient_1d = _get_gradient_frame(frame_w, frame_h)[0]
+    noise_seed = _seed_rng.integers(0, 2 ** 32)
+    _fill_gradient_noise(frame, gradient_1d, noise_seed, out)
+    
+    return out
+
+# .....................................................................................................................
+
+@njit(parallel = True, cache = True)
+def _fill_gradient_noise(frame, gradient_1d, noise_seed, out):
+    
+    frame_h, frame_w, num_channels = frame.shape
+    last_x = frame_w - 1
+    
+    # Generate noise & sum it horizontally (3 pixels, reflected borders) for each row
+    # -> Noise comes from hashing the pixel index (rather than a sequential generator), so it can be vectorized
+    row_sums = np.empty((frame_h, frame_w), dtype = np.uint16)
+    for y in prange(frame_h):
+        noise_row = np.empty(frame_w, dtype = np.uint16)
+        for x in range(frame_w):
+            hash_value = (noise_seed + y * frame_w + x) & 0xFFFFFFFF
+            hash_value ^= (hash_value >> 16)
+            hash_value = (hash_value * 0x7FEB352D) & 0xFFFFFFFF
+            hash_value ^= (hash_value >> 15)
+            hash_value = (hash_value * 0x846CA68B) & 0xFFFFFFFF
+            hash_value ^= (hash_value >> 16)
+            noise_row[x] = ((hash_value & 0xFFFF) * 255) >> 16
+        
+        row_sums[y, 0] = 2 * noise_row[0] + noise_row[min(1, last_x)]
+        for x in range(1, last_x):
+            row_sums[y, x] = noise_row[x - 1] + noise_row[x] + noise_row[x + 1]
+        row_sums[y, last_x] = noise_row[max(last_x - 1, 0)] + 2 * noise_row[last_x]
+    
+    # Finish the (3x3) blur by summing vertically, then scale by the gradient & add to every channel of the frame
+    for y in prange(frame_h):
+        y_prev = max(y - 1, 0)
+        y_next = min(y + 1, frame_h - 1)
+        for x in range(frame_w):
+            noise_sum = np.uint32(row_sums[y_prev, x]) + row_sums[y, x] + row_sums[y_next, x]
+            gradient_noise = np.uint8((((noise_sum + 4) // 9) * np.uint32(gradient_1d[x]) + 127) // 255)
+            for c in range(num_channels):
+                
+                # Saturating uint8 add (overflow wraps around to a smaller value)
+                frame_value = frame[y, x, c]
+                new_value = np.uint8(frame_value + gradient_noise)
+                out[y, x, c] = new_value if new_value >= frame_value else np.uint8(255)
+    
+    return
+
+
+#%% Demo
+
+if __name__ == "__main__":
+    
+    import cv2
+    from utils.frame_makers import make_color_frame
+    from utils.frame_makers import add_gradient_noise as add_gradient_noise_cv2
+    
+    example_wh = (300, 100)
+    blue_bgr = (255, 0, 0)
+    
+    example_frames = [
+            add_gradient_noise_cv2(make_color_frame(blue_bgr, *example_wh)),
+            add_gradient_noise(make_color_frame(blue_bgr, *example_wh))
+    ]
+    
+    combined_image = np.vstack(example_frames)
+    cv2.imshow("OpenCV (top) vs. Numba (bottom)", combined_image)
+    cv2.waitKey(0);
+    cv2.destroyAllWindows()
+
@@ -3,6 +3,8 @@
 
 #%% Imports
 
+from math import floor
+from fractions import Fraction
 
 
 #%% Classes
@@ -11,69 +13,94 @@ class Square_Wave_Timer:
     
     '''
     Helper timer which can be used to check toggle states & whether a toggle occurred for periodic timers
+    Timing is tracked using (integer) frame indices, to avoid drift over long recordings
     Usage:
-        timer.update(current_time_seconds) # Call this to indicate the current 'global' time
+        timer = Square_Wave_Timer(frames_per_sec = 30)
+        timer.register(5, 3) # Optional, sets up the timers ahead of time
+        timer.update(current_frame_index) # Call this to indicate the current 'global' time
         if timer.is_falling(period_sec = 5):
             # do something every 5 seconds
         if timer.is_high(period_sec = 3):
             # do something that lasts 1.5 seconds and repeats every 3 seconds
     '''
     
-    def __init__(self):
+    def __init__(self, frames_per_sec):
+        self._frames_per_sec = frames_per_sec
         self._timers = {}
-        self._curr_time_sec = None
+        self._timer_list = []
+        self._curr_frame_idx = None
     
-    def update(self, curr_time_sec):
-        self._curr_time_sec = curr_time_sec
-        for each_timer in self._timers.values():
-            each_timer.update_timer(curr_time_sec)        
+    def register(self, *period_secs):
+        
+        ''' Optional, creates timers ahead of time (otherwise they're created the first time they're checked) '''
+        
+        for each_period_sec in period_secs:
+            self._get_timer(each_period_sec)
+        return
+    
+    def update(self, curr_frame_idx):
+        self._curr_frame_idx = curr_frame_idx
+        for each_timer in self._timer_list:
+            each_timer.update_timer(curr_frame_idx)        
         return
     
     def is_high(self, period_sec):
-        self._create_missing_timer(period_sec)
-        return self._timers[period_sec].is_high()
+        return self._get_timer(period_sec).is_high()
     
     def is_rising(self, period_sec):
-        self._create_missing_timer(period_sec)
-        return self._timers[period_sec].is_rising()
+        return self._get_timer(period_sec).is_rising()
     
     def is_falling(self, period_sec):
-        self._create_missing_timer(period_sec)
-        return self._timers[period_sec].is_falling()
+        return self._get_timer(period_sec).is_falling()
     
-    def _create_missing_timer(self, period_sec):
-        if period_sec not in self._timers.keys():
-            self._timers[period_sec] = self._Single_Square_Wave_Timer(period_sec, self._curr_time_sec)
-        return
+    def _get_timer(self, period_sec):
+        
+        # Create timers as needed, but keep a list of them as well, for faster iteration when updating
+        single_timer = self._timers.get(period_sec)
+        if single_timer is None:
+            single_timer = self._Single_Square_Wave_Timer(period_sec, self._frames_per_sec, self._curr_frame_idx)
+            self._timers[period_sec] = single_timer
+            self._timer_list.append(single_timer)
+        
+        return single_timer
     
     
     class _Single_Square_Wave_Timer:
         
         ''' Subclass which handles timing of a specific period. Feels hacky to make classes-in-classes... '''
         
-        def __init__(self, period_sec, curr_time_sec):
-            self._toggle_period_sec = period_sec / 2.0
-            self._next_toggle_time = None
+        def __init__(self, period_sec, frames_per_sec, curr_frame_idx):
+            
+            # Store toggle period (in frames) as an exact fraction, since it isn't always a whole number of frames
+            self._toggle_period_frames = Fraction(period_sec) * Fraction(frames_per_sec) / 2
+            self._start_frame_idx = None
+            self._num_toggles = 0
+            self._next_toggle_frame_idx = None
             self._toggle_state = False
             self._is_rising = False
             self._is_falling = False
-            self.update_timer(curr_time_sec)
+            
+            # Timers created before the first update will get their initial state on the first update instead
+            if curr_frame_idx is not None:
+                self.update_timer(curr_frame_idx)
         
-        def update_timer(self, curr_time_sec):
+        def update_timer(self, curr_frame_idx):
             
             # Set initial state
-            if self._next_toggle_time is None:
-                self._set_next_toggle_time(curr_time_sec)
+            if self._next_toggle_frame_idx is None:
+                self._start_frame_idx = curr_frame_idx
+                self._set_next_toggle_frame_idx()
             
-            # Toggle each time we pass the next toggle time
+            # Toggle each time we reach the next toggle frame
             self._is_rising = False
             self._is_falling = False
-            changed_this_frame = (curr_time_sec > self._next_toggle_time)
+            changed_this_frame = (curr_frame_idx >= self._next_toggle_frame_idx)
             if changed_this_frame:
                 self._toggle_state = not self._toggle_state
                 self._is_rising = self._toggle_state
                 self._is_falling = not self._is_rising
-                self._set_next_toggle_time()
+                self._num_toggles += 1
+                self._set_next_toggle_frame_idx()
             
             return self._toggle_state
         
@@ -86,11 +113,11 @@ class Square_Wave_Timer:
         def is_falling(self):
             return self._is_falling
             
-        def _set_next_toggle_time(self, curr_time_sec = None):
+        def _set_next_toggle_frame_idx(self):
             
-            if curr_time_sec is None:
-                curr_time_sec = self._next_toggle_time
-            self._next_toggle_time = curr_time_sec + self._toggle_period_sec
+            # Toggles happen on the first (whole) frame that is past the next toggle time
+            next_toggle_time_frames = self._start_frame_idx + (self._num_toggles + 1) * self._toggle_period_frames
+            self._next_toggle_frame_idx = floor(next_toggle_time_frames) + 1
             
             return
 
@@ -103,7 +130,7 @@ class Square_Wave_Timer:
 if __name__ == "__main__":
     
     print("", "Example 10 second period timer:", sep = "\n")
-    demo_timer_1 = Square_Wave_Timer()
+    demo_timer_1 = Square_Wave_Timer(frames_per_sec = 1)
     for time_sec in range(17):
         demo_timer_1.update(time_sec)
         time_str = "{:.0f}s".format(time_sec)
@@ -117,11 +144,12 @@ if __name__ == "__main__":
             print("{} low".format(time_str))
 
     print("", "Example of 2 & 4 second timers simultaneously:", sep = "\n")
-    demo_timer_2 = Square_Wave_Timer()
+    demo_fps = 100
+    demo_timer_2 = Square_Wave_Timer(frames_per_sec = demo_fps)
     for time_sec in range(20):
         for small_offset in [-0.01, 0.01]:
             offset_time_sec = time_sec + small_offset
-            demo_timer_2.update(offset_time_sec)
+            demo_timer_2.update(int(round(offset_time_sec * demo_fps)))
             time_str = "{:.2f}s".format(offset_time_sec)
             if demo_timer_2.is_falling(2):
                 print("{} 2sec timer is falling".format(time_str))
@@ -2,15 +2,51 @@
 #%% Imports
 
 import os
+import sys
 import cv2
+import json
+import hashlib
+import logging
+import shutil
+import subprocess
 import numpy as np
 
-from itertools import product
+from queue import Empty, Queue
+from fractions import Fraction
+from threading import Lock, Thread
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, TemporaryFile
 
 
-#%%
+#%% Globals
+
+# Logger used to report problems with recordings
+_logger = logging.getLogger(__name__)
+
+# Codecs starting with this prefix are recorded by piping frames into ffmpeg (e.g. 'ffmpeg:libx264')
+FFMPEG_CODEC_PREFIX = "ffmpeg:"
+
+# Backends that can be used for recording (None means the backend is chosen automatically)
+RECORDING_BACKENDS = (None, "cv2", "ffmpeg")
+
+# Codecs that can't record grayscale data directly (grayscale frames are converted to color for these)
+COLOR_ONLY_CODECS = {"avc1", "h264", "H264", "X264"}
+
+# Results from probing for a working codec/extension are stored here, so they can be re-used on later runs
+PROBE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "station_test_patterns", "codec_probe.json")
+
+# Should be changed whenever the probing logic changes, so that results from older versions aren't re-used
+PROBE_CACHE_VERSION = 3
+
+# Storage for folders that have already been created/checked, so we don't need to re-check them for every recording
+_validated_dirs = set()
+_validated_dirs_lock = Lock()
+
+
+#%% Classes
 
 
 class Video_Recorder:
@@ -18,26 +54,58 @@ class Video_Recorder:
     '''
     Convenience wrapper around OpenCV VideoWriter. Adds ability to enable/disable writer,
     timelapse recording (i.e. skip frames), auto frame sizing and auto codec/ext settings
+    Frames are encoded on a background thread, so that slow encoding doesn't stall the caller
+    
+    The 'prime_frames' setting can be used to repeat the first frame of the recording a number of times.
+    Some video players (e.g. Windows Media Player) skip over the first second or so of a video while
+    starting up, so priming prevents the start of the recording from being lost on these players
+    
+    The 'backend' setting can be used to force recording through the OpenCV VideoWriter ('cv2') or by
+    piping frames into ffmpeg ('ffmpeg'). If not set, the backend is chosen based on the codec
+    
+    The 'frame_pool_size' setting controls how many frames are available through acquire_frame(...),
+    which provides re-usable frames that can be drawn into and recorded without copying
     '''
     
-    def __init__(self, save_path, recording_fps = 30.0, timelapse_factor = 1.0, enabled = True, codec = None):
+    def __init__(self, save_path, recording_fps = 30.0, timelapse_factor = 1.0, enabled = True, codec = None,
+                 prime_frames = 0, backend = None, frame_pool_size = 3):
         
         # Store inputs
         self._input_save_path = os.path.abspath(save_path)
+        self._save_folder = os.path.dirname(self._input_save_path)
+        self._name_only, self._orig_ext = os.path.splitext(os.path.basename(self._input_save_path))
         self.recording_fps = float(recording_fps)
         self.tl_factor = float(timelapse_factor)
         self._enabled = enabled
         self._codec = codec
+        self._num_prime_frames = max(0, int(prime_frames))
+        self._backend = backend
+        self._frame_pool_size = max(1, int(frame_pool_size))
         
         # Allocate variables for recording
         self._vwriter = None
+        self._write_fn = None
+        self._is_color = None
         self._write_wh = None
         self._actual_ext = None
         self._actual_save_path = None
+        self._probe_cache_key = None
+        
+        # Allocate variables for background writing
+        self._frame_queue = None
+        self._writer_thread = None
+        self._writer_error = None
+        
+        # Allocate variables for re-usable frames (created on first use)
+        self._frame_pool = None
+        self._frame_pool_spec = None
         
         # Pre-determine whether we're timelapsing for convenience
-        self._tl_increment = 1.0 / max(1.0, timelapse_factor)
-        self._tl_count = 1.0
+        # -> Timelapse factor is stored as an integer ratio (step/period), so frame skipping doesn't drift over time
+        tl_ratio = Fraction(max(1.0, timelapse_factor)).limit_denominator(1000)
+        self._tl_step = tl_ratio.denominator
+        self._tl_period = tl_ratio.numerator
+        self._tl_idx = self._tl_period - self._tl_step
         self._tl_enabled = (timelapse_factor - 1.0 > 0.01)
         
         # Timelapse factors less than 1 aren't supported (requires duplicating frames)
@@ -45,6 +113,10 @@ class Video_Recorder:
         if timelapse_below_1:
             raise ValueError("Cannot set timelapse factor below 1!")
         
+        # Make sure we got a backend we know how to use
+        if backend not in RECORDING_BACKENDS:
+            raise ValueError("Invalid backend! Must be one of: {}, got: {}".format(RECORDING_BACKENDS, backend))
+        
         # Set up video encoding settings
         self._figure_out_encoding()
     
@@ -58,9 +130,14 @@ class Video_Recorder:
             True/False
         '''
         
-        if self._vwriter is None:
+        # Not open if we haven't started writing (or have been released) or if writing has failed
+        if self._writer_thread is None or self._writer_error is not None:
             return False
         
+        # The video writer is created on the background thread, so may not exist yet right after the first write
+        if self._vwriter is None:
+            return True
+        
         return self._vwriter.isOpened()
     
     # .................................................................................................................
@@ -87,42 +164,83 @@ class Video_Recorder:
     
     # .................................................................................................................
 
+    def sync(self):
+        
+        '''
+        Wait until all frames passed to the write function have been written by the background writer.
+        Useful as a 'flush' barrier, for example before reading back the recorded file.
+        Raises any error that occurred while writing, since the recorded file will be incomplete in that case
+        Returns:
+            Nothing
+        '''
+        
+        if self._writer_thread is not None:
+            self._frame_queue.join()
+        
+        if self._writer_error is not None:
+            raise self._writer_error
+        
+        return
+    
+    # .................................................................................................................
+
     def release(self):
         
         '''
         Close the video writer. This is important for getting correctly formatted video files!
+        Any error that occurred while writing queued frames (on the background writer) is raised here
         Returns:
             Nothing
         '''
         
+        # Signal the background writer to finish up any queued frames & wait for it to stop
+        if self._writer_thread is not None:
+            self._frame_queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+            
+            # Go back to using the general-purpose write function, since the specialized one relies on the writer
+            self.__dict__.pop("write", None)
+        
         if self._vwriter is not None:
             self._vwriter.release()
             
             # Sanity check, make sure a file was saved & isn't empty
-            error_with_saved_file = True
-            if os.path.exists(self._actual_save_path):
-                SIZE_500_BYTES = 500
-                error_with_saved_file = (os.path.getsize(self._actual_save_path) < SIZE_500_BYTES)
+            SIZE_500_BYTES = 500
+            try:
+                error_with_saved_file = (os.stat(self._actual_save_path).st_size < SIZE_500_BYTES)
+            except FileNotFoundError:
+                error_with_saved_file = True
             
             # Warning for user if something went wrong
             if error_with_saved_file:
-                print("",
-                      "WARNING:",
-                      "Recorded video file may be corrupted!",
-                      "This can be caused by bad codec/file extension settings",
-                      "      Codec used: {}".format(self._codec),
-                      "  Extension used: {}".format(self._actual_ext), sep = "\n")
+                _logger.warning("Recorded video file may be corrupted! "
+                                "This can be caused by bad codec/file extension settings (codec: %s, extension: %s)",
+                                self._codec, self._actual_ext)
+        
+        # Pass on errors from the background writer, otherwise failures on the last few frames would go unnoticed
+        writer_error = self._writer_error
+        if writer_error is not None:
+            self._writer_error = None
+            raise writer_error
         
         return
     
     # .................................................................................................................
     
-    def write(self, frame):
+    def write(self, frame, copy_frame = True, on_written = None):
         
         '''
         Records frame data as a video (if this writer is enabled).
         Inputs:
             frame: image data to be recorded (must be a consistently sized image!)
+            
+            copy_frame: If False, the frame data is handed to the background writer without copying.
+                        In this case, the caller must not modify the frame until it has been written!
+                        (non-contiguous frame data, e.g. a sliced view, is always copied)
+            
+            on_written: Optional function, called (with no arguments, from the writer thread) once the frame
+                        has been written. Only called if the frame was accepted (i.e. this function returns True)
         
         Returns:
             True/False (True if the frame was written, False otherwise)
@@ -139,30 +257,323 @@ class Video_Recorder:
         if self._tl_enabled:
             
             # Skip frames until we count to/over a full timelapsed cycle
-            self._tl_count += self._tl_increment
-            if self._tl_count < 1:
+            self._tl_idx += self._tl_step
+            if self._tl_idx < self._tl_period:
                 return frame_was_written
             
             # Reset the timelapsed count for future iterations
-            self._tl_count -= 1.0
+            self._tl_idx -= self._tl_period
         
-        # Write the current frame
-        try:
-            self._vwriter.write(frame)
-            frame_was_written = True
+        # Pass errors from the background writer on to the caller, otherwise we'd silently fill up the queue
+        if self._writer_error is not None:
+            raise self._writer_error
+        
+        # Start up the background writer on first use, which handles the actual encoding of frames
+        if self._writer_thread is None:
+            self._start_writer_thread()
+        
+        # Hand the frame to the background writer. Copy by default, since the caller may re-use the frame data
+        queued_frame = frame.copy() if copy_frame else np.ascontiguousarray(frame)
+        self._frame_queue.put(((queued_frame,), on_written))
+        frame_was_written = True
+        
+        return frame_was_written
+    
+    # .................................................................................................................
+    
+    def write_many(self, frames, copy_frames = True, on_written = None):
+        
+        '''
+        Records a sequence of frames (e.g. a buffer of previously captured frames).
+        Equivalent to calling write(...) on each frame, but the frames are handed to
+        the background writer as a single batch
+        Inputs:
+            frames: iterable of image data to be recorded
+            
+            copy_frames: If False, the frame data is handed to the background writer without copying
+            
+            on_written: Optional function, called once all of the (accepted) frames have been written
+        
+        Returns:
+            num_frames_written
+        '''
+        
+        # Bail if recording is disabled
+        if not self._enabled:
+            return 0
+        
+        # Handle timelapsing if needed, by picking out only the frames to be kept
+        if self._tl_enabled:
+            kept_frames = []
+            for each_frame in frames:
+                self._tl_idx += self._tl_step
+                if self._tl_idx < self._tl_period:
+                    continue
+                self._tl_idx -= self._tl_period
+                kept_frames.append(each_frame)
+        else:
+            kept_frames = list(frames)
+        
+        # Bail if there's nothing to write
+        num_frames_written = len(kept_frames)
+        if num_frames_written == 0:
+            return num_frames_written
+        
+        # Pass errors from the background writer on to the caller
+        if self._writer_error is not None:
+            raise self._writer_error
+        
+        # Start up the background writer on first use
+        if self._writer_thread is None:
+            self._start_writer_thread()
+        
+        # Hand all frames to the background writer at once
+        copy_func = np.copy if copy_frames else np.ascontiguousarray
+        queued_frames = [copy_func(each_frame) for each_frame in kept_frames]
+        self._frame_queue.put((queued_frames, on_written))
+        
+        return num_frames_written
+    
+    # .................................................................................................................
+    
+    def write_raw(self, frame_data, frame_shape, copy_frame = True, on_written = None):
+        
+        '''
+        Records frame data provided as a raw (uint8) buffer, for example bytes read back from a render target.
+        The buffer is wrapped without copying, so it doesn't need to be converted to an array first.
+        Inputs:
+            frame_data: bytes-like object (bytes, bytearray, memoryview etc.) holding the frame data
+            
+            frame_shape: shape of the frame data, e.g. (height, width, 3)
             
-        except AttributeError:
-            # Attribute error occurs when we haven't setup the vwriter yet (i.e. it is None)
+            copy_frame, on_written: Same as the write(...) function. Note that a copy isn't needed
+                                    for data that can't be modified (e.g. bytes)
+        
+        Returns:
+            True/False (True if the frame was written, False otherwise)
+        '''
+        
+        frame = np.frombuffer(frame_data, dtype = np.uint8).reshape(frame_shape)
+        
+        return self.write(frame, copy_frame, on_written)
+    
+    # .................................................................................................................
+    
+    def acquire_frame(self, frame_shape, dtype = np.uint8):
+        
+        '''
+        Provides a (pre-allocated) frame that can be drawn into and then recorded using submit(...)
+        Frames are returned to a small pool once they've been written, so that new frames don't need to be
+        allocated. Waits for a frame to finish writing if all frames are in use.
+        Note that frames are not cleared, so they will contain whatever was last drawn into them!
+        Inputs:
+            frame_shape: shape of the frame, e.g. (height, width, 3). Must be the same on every call
             
-            # Create a video writer & write the frame again (No error handling this time, but hopefully we're ok...)
-            self._vwriter = self._create_video_writer(frame.shape)
-            self._vwriter.write(frame)
-            frame_was_written = True
+            dtype: data type of the frame
+        
+        Returns:
+            frame
+        '''
+        
+        # Allocate all frames on first use
+        frame_spec = (tuple(frame_shape), np.dtype(dtype))
+        if self._frame_pool is None:
+            self._frame_pool = Queue()
+            self._frame_pool_spec = frame_spec
+            for _ in range(self._frame_pool_size):
+                self._frame_pool.put(np.empty(frame_shape, dtype = dtype))
+        
+        # Pooled frames are re-used, so they can't change shape/type
+        if frame_spec != self._frame_pool_spec:
+            raise ValueError("Cannot change frame shape/type of acquired frames! Expecting: {}, got: {}"
+                             .format(self._frame_pool_spec, frame_spec))
+        
+        # If writing has failed, don't wait on frames that may never be returned, pass on the error instead
+        if self._writer_error is not None:
+            try:
+                return self._frame_pool.get_nowait()
+            except Empty:
+                raise self._writer_error
+        
+        return self._frame_pool.get()
+    
+    # .................................................................................................................
+    
+    def submit(self, frame):
+        
+        '''
+        Records a frame provided by acquire_frame(...), without copying it. The frame is returned to the pool
+        once it's been written (or immediately if it isn't being recorded), so it shouldn't be used after this!
+        Returns:
+            True/False (True if the frame was written, False otherwise)
+        '''
+        
+        # Make sure the frame goes back into the pool if it isn't queued (including if writing raises an error)
+        return_to_pool = partial(self._frame_pool.put, frame)
+        try:
+            frame_was_written = self.write(frame, copy_frame = False, on_written = return_to_pool)
+        except BaseException:
+            return_to_pool()
+            raise
+        if not frame_was_written:
+            return_to_pool()
         
         return frame_was_written
     
     # .................................................................................................................
     
+    def _writer_loop(self):
+        
+        ''' Function run by the background writer thread. Writes queued frames until a 'None' item is received '''
+        
+        while True:
+            
+            # Stop once we get the signal to finish
+            queue_item = self._frame_queue.get()
+            if queue_item is None:
+                self._frame_queue.task_done()
+                break
+            frames, on_written = queue_item
+            
+            try:
+                # Write the current frame(s), unless writing has already failed (but keep emptying the queue)
+                if self._writer_error is None:
+                    try:
+                        write_fn = self._write_fn
+                        if write_fn is None:
+                            self._ensure_writer(frames[0])
+                            write_fn = self._write_fn
+                            for _ in range(self._num_prime_frames):
+                                write_fn(frames[0])
+                        for each_frame in frames:
+                            write_fn(each_frame)
+                        
+                    except Exception as err:
+                        self._writer_error = self._make_writer_error(err)
+                
+                # Let the caller know we're done with the frame data (even if writing failed)
+                if on_written is not None:
+                    on_written()
+                
+            except Exception as err:
+                # Errors from the caller's function are passed on to the caller, like errors from writing
+                if self._writer_error is None:
+                    self._writer_error = err
+                
+            finally:
+                # Always mark the item as done, otherwise sync/release would wait forever
+                self._frame_queue.task_done()
+        
+        return
+    
+    # .................................................................................................................
+    
+    def _make_writer_error(self, error):
+        
+        '''
+        Helper used to handle errors from writing. If the codec was chosen automatically (and possibly re-used
+        from an earlier run) and the encoder itself failed, the codec is removed from the probe cache so that
+        it gets re-checked on the next run. Any other error is passed on unchanged
+        '''
+        
+        # Problems with the save folder aren't the codec's fault (also re-check the folder on the next recording)
+        folder_ok = _is_folder_writable(self._save_folder)
+        if not folder_ok:
+            with _validated_dirs_lock:
+                _validated_dirs.discard(self._save_folder)
+        
+        # Only blame the codec if the writer couldn't be opened or the encoder (ffmpeg) quit unexpectedly
+        writer_not_opened = (self._vwriter is not None) and (not self._vwriter.isOpened())
+        encoder_failed = folder_ok and (writer_not_opened or isinstance(error, BrokenPipeError))
+        if self._probe_cache_key is None or not encoder_failed:
+            return error
+        
+        _remove_probe_cache_entry(self._probe_cache_key)
+        writer_error = IOError("Error recording with auto-selected codec: {}. The codec has been removed from {}, "
+                               "so a new codec will be selected on the next run".format(self._codec, PROBE_CACHE_PATH))
+        writer_error.__cause__ = error
+        
+        return writer_error
+    
+    # .................................................................................................................
+    
+    def _ensure_writer(self, frame):
+        
+        ''' Helper used to set up the video writer (based on the first frame) & store its write function for re-use '''
+        
+        # Record grayscale frames as grayscale, unless the codec only supports color
+        frame_is_color = (frame.ndim == 3 and frame.shape[2] == 3)
+        codec_needs_color = (self._codec.startswith(FFMPEG_CODEC_PREFIX) or self._codec in COLOR_ONLY_CODECS)
+        self._is_color = (frame_is_color or codec_needs_color)
+        
+        self._vwriter = self._create_video_writer(frame.shape, self._is_color)
+        if not self._vwriter.isOpened():
+            raise IOError("Couldn't open video writer! (codec: {}, save path: {})"
+                          .format(self._codec, self._actual_save_path))
+        self._write_fn = self._vwriter.write
+        
+        # Convert grayscale frames to color before writing, if needed
+        if self._is_color and not frame_is_color:
+            vwriter_write = self._vwriter.write
+            def write_gray_as_color(frame):
+                return vwriter_write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+            self._write_fn = write_gray_as_color
+        
+        return
+    
+    # .................................................................................................................
+    
+    def _start_writer_thread(self):
+        
+        '''
+        Helper used to start the background writer. The queue is kept short, so that a slow encoder
+        applies back-pressure to the caller rather than buffering up lots of (copied) frames in memory
+        '''
+        
+        self._frame_queue = Queue(maxsize = 8)
+        self._writer_thread = Thread(target = self._writer_loop, daemon = True)
+        self._writer_thread.start()
+        
+        # Now that the writer is running, swap in a write function that skips the setup checks
+        self.write = self._make_write_fn()
+        
+        return
+    
+    # .................................................................................................................
+    
+    def _make_write_fn(self):
+        
+        '''
+        Helper used to build a replacement for the write(...) function, specialized to the recording settings.
+        Only valid once the background writer is running (recording settings don't change after that point)
+        '''
+        
+        frame_queue_put = self._frame_queue.put
+        
+        def write_frame(frame, copy_frame = True, on_written = None):
+            if self._writer_error is not None:
+                raise self._writer_error
+            queued_frame = frame.copy() if copy_frame else np.ascontiguousarray(frame)
+            frame_queue_put(((queued_frame,), on_written))
+            return True
+        
+        # Without timelapsing, every frame is written
+        if not self._tl_enabled:
+            return write_frame
+        
+        tl_step = self._tl_step
+        tl_period = self._tl_period
+        def write_timelapse_frame(frame, copy_frame = True, on_written = None):
+            self._tl_idx += tl_step
+            if self._tl_idx < tl_period:
+                return False
+            self._tl_idx -= tl_period
+            return write_frame(frame, copy_frame, on_written)
+        
+        return write_timelapse_frame
+    
+    # .................................................................................................................
+    
     def _figure_out_encoding(self):
         
         ''' Helper function used to determine video valid codec/extension combo & adjust save naming accordingly '''
@@ -171,17 +582,29 @@ class Video_Recorder:
         if not self._enabled:
             return
         
-        # Break up save name, since we may need to modify the extension
-        save_folder = os.path.dirname(self._input_save_path)
-        orig_full_name = os.path.basename(self._input_save_path)
-        name_only, orig_ext = os.path.splitext(orig_full_name)
-        
         # Auto-determine the saving format if needed
-        actual_ext = orig_ext.replace(".", "")
+        actual_ext = self._orig_ext.replace(".", "")
         if self._codec is None:
-            encode_ok, actual_codec, actual_ext = find_valid_recording_parameters(actual_ext)
+            if self._backend == "ffmpeg" and shutil.which("ffmpeg") is None:
+                raise IOError("Couldn't find ffmpeg! Cannot record video using backend: {}".format(self._backend))
+            self._probe_cache_key = _get_probe_cache_key(actual_ext, self._backend)
+            encode_ok, actual_codec, actual_ext = find_valid_recording_parameters(actual_ext, backend = self._backend)
             if not encode_ok:
                 raise IOError("Bad codec/extension! Cannot record video")
+        
+        # Make sure the codec matches the backend, if the backend was given (ffmpeg codecs use a prefix)
+        elif self._backend == "ffmpeg" or str(self._codec).startswith(FFMPEG_CODEC_PREFIX):
+            if self._backend == "cv2":
+                raise ValueError("Cannot use an ffmpeg codec with the cv2 backend, got: {}".format(self._codec))
+            
+            # Make sure ffmpeg is available, it will choose the container format based on the extension
+            actual_codec = str(self._codec)
+            if not actual_codec.startswith(FFMPEG_CODEC_PREFIX):
+                actual_codec = "{}{}".format(FFMPEG_CODEC_PREFIX, actual_codec)
+            if shutil.which("ffmpeg") is None:
+                raise IOError("Couldn't find ffmpeg! Cannot record video using codec: {}".format(actual_codec))
+            if actual_ext == "":
+                actual_ext = "mp4"
         else:
             # Make sure codec is 4 character, since 'fourcc' setting requires characters
             actual_codec = str(self._codec)
@@ -190,8 +613,8 @@ class Video_Recorder:
                 raise ValueError("Invalid codec! Must be 4 characters, got: {}".format(actual_codec))
         
         # Re-write the save pathing, in case the extension changed
-        save_full_name = "{}.{}".format(name_only, actual_ext)
-        save_path = os.path.join(save_folder, save_full_name)
+        save_full_name = "{}.{}".format(self._name_only, actual_ext)
+        save_path = os.path.join(self._save_folder, save_full_name)
         
         # Store codec/ext and final pathing for reference
         self._codec = actual_codec
@@ -202,7 +625,7 @@ class Video_Recorder:
     
     # .................................................................................................................
     
-    def _create_video_writer(self, frame_shape):
+    def _create_video_writer(self, frame_shape, is_color = True):
         
         # Some sanity checks
         if frame_shape is None:
@@ -214,12 +637,19 @@ class Video_Recorder:
         write_h, write_w = frame_shape[0:2]
         self._write_wh = (write_w, write_h)
         
-        # Make sure the folder we're saving to actually exists!
-        save_folder = os.path.dirname(self._actual_save_path)
-        os.makedirs(save_folder, exist_ok = True)
+        # Make sure the folder we're saving to actually exists! (only need to check once per folder)
+        save_folder = self._save_folder
+        with _validated_dirs_lock:
+            if save_folder not in _validated_dirs:
+                os.makedirs(save_folder, exist_ok = True)
+                _validated_dirs.add(save_folder)
         
-        # Create OCV video writer, assume frame data is color (even when grayscale, which seems to be less buggy)
-        is_color = True
+        # Pipe frames into ffmpeg if needed, instead of using the OCV video writer
+        if self._codec.startswith(FFMPEG_CODEC_PREFIX):
+            ffmpeg_encoder = self._codec[len(FFMPEG_CODEC_PREFIX):]
+            return FFmpeg_Pipe_Writer(self._actual_save_path, self.recording_fps, self._write_wh, ffmpeg_encoder)
+        
+        # Create OCV video writer
         fourcc = cv2.VideoWriter_fourcc(*self._codec)
         new_vwriter = cv2.VideoWriter(self._actual_save_path,
                                       fourcc,
@@ -233,72 +663,414 @@ class Video_Recorder:
     # .................................................................................................................
 
 
+class FFmpeg_Pipe_Writer:
+    
+    '''
+    Stand-in for the OpenCV VideoWriter, which pipes raw (BGR) frame data into an ffmpeg process.
+    This gives access to faster encoder settings and hardware encoders (e.g. 'h264_nvenc')
+    '''
+    
+    def __init__(self, save_path, recording_fps, frame_wh, encoder = "libx264", show_errors = True):
+        
+        # Fill in default encoder if needed
+        if encoder is None or encoder == "":
+            encoder = "libx264"
+        
+        # Use the fastest preset for software encoders, since we're more concerned about speed than file size
+        encoder_args = ["-c:v", encoder]
+        if encoder in {"libx264", "libx265"}:
+            encoder_args += ["-preset", "ultrafast"]
+        
+        # Build ffmpeg command. Frames are padded to even sizing, which is required for yuv420p output
+        frame_w, frame_h = frame_wh
+        ffmpeg_cmd = ["ffmpeg", "-y", "-loglevel", "error",
+                      "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "{}x{}".format(frame_w, frame_h),
+                      "-r", str(recording_fps), "-i", "-",
+                      *encoder_args,
+                      "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p",
+                      save_path]
+        
+        # Use a buffered pipe, which (unlike an unbuffered pipe) always writes all of the frame data on each write
+        stderr_target = None if show_errors else subprocess.DEVNULL
+        self._proc = subprocess.Popen(ffmpeg_cmd, stdin = subprocess.PIPE, stderr = stderr_target)
+    
+    # .................................................................................................................
+    
+    def isOpened(self):
+        return (self._proc.poll() is None)
+    
+    # .................................................................................................................
+    
+    def write(self, frame):
+        self._proc.stdin.write(np.ascontiguousarray(frame).data)
+    
+    # .................................................................................................................
+    
+    def release(self):
+        
+        try:
+            if self._proc.stdin is not None and not self._proc.stdin.closed:
+                self._proc.stdin.close()
+        except OSError:
+            # Can fail to flush if ffmpeg has already quit, nothing to do about that here
+            pass
+        self._proc.wait()
+    
+    # .................................................................................................................
+    
+    def get_return_code(self):
+        
+        ''' Provides the ffmpeg exit code (None if ffmpeg is still running) '''
+        
+        return self._proc.poll()
+    
+    # .................................................................................................................
+    # .................................................................................................................
+
+
 #%% Functions
 
-def find_valid_recording_parameters(preferred_ext = None):
+def find_valid_recording_parameters(preferred_ext = None, use_cache = True, backend = None):
+    
+    '''
+    Finds a working codec/extension combination for recording, preferring the given extension if possible.
+    Results are cached on disk (see PROBE_CACHE_PATH), since probing requires encoding a number of test videos
+    The backend can be set to 'cv2' or 'ffmpeg' to only check that backend, otherwise ffmpeg is preferred
+    Returns:
+        output_ok, codec_str, ext
+    '''
+    
+    # Re-use results from a previous run if possible (key changes if OpenCV or ffmpeg change)
+    cache_key = _get_probe_cache_key(preferred_ext, backend)
+    if use_cache:
+        cached_result = _load_probe_cache().get(cache_key, None)
+        if cached_result is not None:
+            cached_codec_str, cached_ext = cached_result
+            return True, cached_codec_str, cached_ext
+    
+    # Run the (slow) probe & save working results for re-use
+    output_ok, good_codec_str, good_ext = _probe_recording_parameters(preferred_ext, backend)
+    if output_ok and use_cache:
+        _save_probe_cache(cache_key, good_codec_str, good_ext)
+    
+    return output_ok, good_codec_str, good_ext
+
+# .....................................................................................................................
+
+def _probe_recording_parameters(preferred_ext = None, backend = None):
     
-    # Hard-code the list of codec/extensions to test
-    codecs_list = ["avc1", "XVID", "MJPG"]
-    exts_list = ["mp4", "mkv", "avi"]
+    # Prefer recording through ffmpeg (ideally with a hardware encoder), if it's available
+    if backend != "cv2":
+        ffmpeg_ok, ffmpeg_codec_str, ffmpeg_ext = find_valid_ffmpeg_parameters(preferred_ext)
+        
+        # If ffmpeg is forced, we have to switch extensions if the preferred one isn't supported by ffmpeg
+        if not ffmpeg_ok and backend == "ffmpeg":
+            ffmpeg_ok, ffmpeg_codec_str, ffmpeg_ext = find_valid_ffmpeg_parameters(None)
+        
+        if ffmpeg_ok or backend == "ffmpeg":
+            return ffmpeg_ok, ffmpeg_codec_str, ffmpeg_ext
     
-    # Place user-provided ext at top of exts-list
+    # Hard-code the list of codec/extensions to test (only pairings that are known to work together)
+    # -> Order depends on the OS, so that the pairing most likely to work is tried first
+    if sys.platform == "win32":
+        # avc1 often fails on windows, since OpenCV doesn't ship with an h264 encoder
+        codec_ext_pairs = [("MJPG", "avi"), ("XVID", "avi"),
+                           ("avc1", "mp4"), ("avc1", "mkv"),
+                           ("MJPG", "mkv"), ("XVID", "mkv")]
+    elif sys.platform == "darwin":
+        codec_ext_pairs = [("avc1", "mp4"), ("MJPG", "avi"),
+                           ("avc1", "mkv"), ("XVID", "avi"),
+                           ("MJPG", "mkv"), ("XVID", "mkv")]
+    else:
+        codec_ext_pairs = [("avc1", "mp4"), ("avc1", "mkv"),
+                           ("XVID", "avi"), ("XVID", "mkv"),
+                           ("MJPG", "avi"), ("MJPG", "mkv")]
+    
+    # Place pairs using the user-provided ext at the top of the list (or try it with every codec if it's unknown)
     valid_user_ext = (preferred_ext is not None) and (preferred_ext != "")
     if valid_user_ext:
         preferred_ext = preferred_ext.replace(".", "")
-        if preferred_ext in exts_list:
-            exts_list.remove(preferred_ext)
-        exts_list.insert(0, preferred_ext)
+        user_ext_pairs = [each_pair for each_pair in codec_ext_pairs if each_pair[1] == preferred_ext]
+        if len(user_ext_pairs) == 0:
+            codecs_list = list(dict.fromkeys(each_codec for each_codec, _ in codec_ext_pairs))
+            user_ext_pairs = [(each_codec, preferred_ext) for each_codec in codecs_list]
+        other_pairs = [each_pair for each_pair in codec_ext_pairs if each_pair not in user_ext_pairs]
+        codec_ext_pairs = user_ext_pairs + other_pairs
+    
+    # Initialize outputs
+    good_codec_str = None
+    good_ext = None
+    
+    # Test recording of codec/ext pairs (in parallel) in a temporary folder, until we find one that works
+    # -> Bad combinations print (lots of) warnings, which aren't useful to the user, so hide them while probing
+    with TemporaryDirectory() as temp_dir_path, _silence_stderr():
+        
+        # Start testing all pairs, each in it's own folder to avoid naming conflicts
+        probe_executor = ThreadPoolExecutor(max_workers = 3)
+        probe_futures = []
+        for pair_idx, (each_codec_str, each_ext) in enumerate(codec_ext_pairs):
+            probe_folder_path = os.path.join(temp_dir_path, str(pair_idx))
+            probe_futures.append(probe_executor.submit(_probe_codec_ext, each_codec_str, each_ext, probe_folder_path))
+        
+        # Take the first working pair in order of preference (not the first to finish) & skip remaining tests
+        try:
+            for (each_codec_str, each_ext), each_future in zip(codec_ext_pairs, probe_futures):
+                if each_future.result():
+                    good_codec_str = each_codec_str
+                    good_ext = each_ext
+                    break
+        
+        finally:
+            # Make sure tests that are already running are finished before the temporary folder is removed
+            probe_executor.shutdown(wait = True, cancel_futures = True)
+    
+    # Last check to make sure we got something useful
+    output_ok = (good_codec_str is not None) and (good_ext is not None)
+    
+    return output_ok, good_codec_str, good_ext
+
+# .....................................................................................................................
+
+def _probe_codec_ext(codec_str, ext, folder_path):
+    
+    ''' Helper used to check if a codec/extension pair works, by recording a small video into the given folder '''
     
     # Hard-code some recording settings
     is_color = True
     fps = 30.0
     frame_wh = (8, 8)
+    num_frames = 2
+    
+    # Create a dummy frame to record
+    dummy_frame = np.zeros((frame_wh[1], frame_wh[0], 3), dtype = np.uint8)
+    
+    # Build save pathing
+    os.makedirs(folder_path, exist_ok = True)
+    save_name = "{}.{}".format(codec_str, ext)
+    save_path = os.path.join(folder_path, save_name)
+    
+    # Create video writer & write dummy frames
+    fourcc_int = cv2.VideoWriter_fourcc(*codec_str)
+    vwriter = cv2.VideoWriter(save_path, fourcc_int, fps, frame_wh, is_color)
+    for _ in range(num_frames):
+        vwriter.write(dummy_frame)
+    vwriter.release()
+    
+    # Make sure something was saved at least (existance doesn't guarentee validity though)
+    file_exists = (os.path.exists(save_path))
+    if not file_exists:
+        return False
+    
+    # Bad codec/ext combinations can create files that aren't empty but still can't be played back,
+    # so make sure we can actually read a frame back out of the saved file
+    vreader = cv2.VideoCapture(save_path)
+    read_ok, _ = vreader.read()
+    vreader.release()
+    
+    return read_ok
+
+# .....................................................................................................................
+
+def find_valid_ffmpeg_parameters(preferred_ext = None):
+    
+    '''
+    Checks for a working ffmpeg encoder, in order of preference (hardware encoders first).
+    Fails if the preferred ext is given but isn't a container that we record into with ffmpeg
+    Returns:
+        output_ok, codec_str (e.g. 'ffmpeg:h264_nvenc'), ext
+    '''
+    
+    # Hard-code the list of encoders to test, from most-to-least preferred (videotoolbox only exists on macs)
+    if sys.platform == "darwin":
+        encoders_list = ["h264_videotoolbox", "libx264"]
+    else:
+        encoders_list = ["h264_nvenc", "h264_qsv", "libx264"]
+    
+    # Use user-provided ext if it's a container that supports h264, otherwise leave it to other codecs
+    good_ext = "mp4"
+    valid_user_ext = (preferred_ext is not None) and (preferred_ext != "")
+    if valid_user_ext:
+        preferred_ext = preferred_ext.replace(".", "")
+        if preferred_ext not in {"mp4", "mkv", "mov"}:
+            return False, None, None
+        good_ext = preferred_ext
+    
+    # Bail if we don't have ffmpeg at all
+    if shutil.which("ffmpeg") is None:
+        return False, None, None
+    
+    # Only bother testing the encoders that ffmpeg was built with
+    encoders_result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"],
+                                     stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+    encoders_list = [each_encoder for each_encoder in encoders_list if each_encoder in encoders_result.stdout]
+    
+    # Hard-code some recording settings (hardware encoders may have a minimum frame size, so don't go too small)
+    fps = 30.0
+    frame_wh = (320, 240)
     num_frames = 5
     
     # Create a dummy frame to record
-    dummy_frame = np.random.randint(0, 255, (frame_wh[1], frame_wh[0], 3), dtype = np.uint8)
+    dummy_frame = np.zeros((frame_wh[1], frame_wh[0], 3), dtype = np.uint8)
     
-    # Initialize outputs
+    # Test recording with each encoder in a temporary folder until we find one that works
+    # -> Encoders may be listed even if the matching hardware isn't present, so we need to actually try them out
     good_codec_str = None
-    good_ext = None
-    
-    # Test recording of codec/ext pairs in a temporary folder until we find one that works
-    codec_ext_pairs = product(codecs_list, exts_list)
     with TemporaryDirectory() as temp_dir_path:
         
-        # Loop through each codec/extension until we successfully create a file
-        for each_codec_str, each_ext in codec_ext_pairs:
-            
-            # Build save pathing
-            save_name = "{}.{}".format(each_codec_str, each_ext)
-            save_path = os.path.join(temp_dir_path, save_name)
+        for each_encoder in encoders_list:
             
-            # Create video writer & write dummy frames
-            fourcc_int = cv2.VideoWriter_fourcc(*each_codec_str)
-            vwriter = cv2.VideoWriter(save_path, fourcc_int, fps, frame_wh, is_color)
-            for _ in range(num_frames):
-                vwriter.write(dummy_frame)
+            save_path = os.path.join(temp_dir_path, "{}.{}".format(each_encoder, good_ext))
+            vwriter = FFmpeg_Pipe_Writer(save_path, fps, frame_wh, each_encoder, show_errors = False)
+            try:
+                for _ in range(num_frames):
+                    vwriter.write(dummy_frame)
+            except OSError:
+                # Occurs if ffmpeg quits early (e.g. unusable encoder), since frames can't be written into it
+                pass
             vwriter.release()
             
-            # Make sure something was saved at least (existance doesn't guarentee validity though)
-            file_exists = (os.path.exists(save_path))
-            if not file_exists:
-                continue
-            
-            # Bad codec/ext combinations create empty files
-            nonzero_file_size = os.path.getsize(save_path) > 500
-            if nonzero_file_size:
-                good_codec_str = each_codec_str
-                good_ext = each_ext
+            # Failed encoders exit with an error code & leave no (or an empty) file
+            encode_ok = (vwriter.get_return_code() == 0)
+            file_ok = os.path.exists(save_path) and (os.path.getsize(save_path) > 500)
+            if encode_ok and file_ok:
+                good_codec_str = "{}{}".format(FFMPEG_CODEC_PREFIX, each_encoder)
                 break
     
     # Last check to make sure we got something useful
-    output_ok = (good_codec_str is not None) and (good_ext is not None)
+    output_ok = (good_codec_str is not None)
+    if not output_ok:
+        good_ext = None
     
     return output_ok, good_codec_str, good_ext
 
 
+# .....................................................................................................................
+
+@contextmanager
+def _silence_stderr():
+    
+    '''
+    Context manager used to hide stderr output (including output from OpenCV/ffmpeg internals, which
+    doesn't go through python) by temporarily pointing the stderr file descriptor at the null device
+    '''
+    
+    # Turn off OpenCV logging as well, if available (log level 0 is 'silent')
+    has_log_level = hasattr(cv2, "getLogLevel") and hasattr(cv2, "setLogLevel")
+    orig_log_level = cv2.getLogLevel() if has_log_level else None
+    if has_log_level:
+        cv2.setLogLevel(0)
+    
+    # Make sure any already-buffered messages are printed before hiding stderr
+    sys.stderr.flush()
+    saved_stderr_fd = os.dup(2)
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull_fd, 2)
+    
+    try:
+        yield
+        
+    finally:
+        os.dup2(saved_stderr_fd, 2)
+        os.close(saved_stderr_fd)
+        os.close(devnull_fd)
+        if has_log_level:
+            cv2.setLogLevel(orig_log_level)
+    
+    return
+
+# .....................................................................................................................
+
+def _is_folder_writable(folder_path):
+    
+    ''' Helper used to check if files can be saved into a folder, by (briefly) creating a file in it '''
+    
+    try:
+        with TemporaryFile(dir = folder_path):
+            pass
+    except OSError:
+        return False
+    
+    return True
+
+# .....................................................................................................................
+
+def _get_probe_cache_key(preferred_ext, backend = None):
+    
+    ''' Helper used to build a key for caching probe results, which depends on the OpenCV build & ffmpeg install '''
+    
+    key_data = "\n".join([str(PROBE_CACHE_VERSION), cv2.getBuildInformation(), str(shutil.which("ffmpeg")),
+                          str(preferred_ext), str(backend)])
+    
+    return hashlib.sha1(key_data.encode()).hexdigest()[:16]
+
+# .....................................................................................................................
+
+def _load_probe_cache():
+    
+    ''' Helper used to load previously cached probe results. Returns an empty dictionary if loading fails '''
+    
+    try:
+        with open(PROBE_CACHE_PATH, "r") as in_file:
+            cache_dict = json.load(in_file)
+        if not isinstance(cache_dict, dict):
+            cache_dict = {}
+        
+    except (OSError, ValueError):
+        cache_dict = {}
+    
+    return cache_dict
+
+# .....................................................................................................................
+
+def _save_probe_cache(cache_key, codec_str, ext):
+    
+    ''' Helper used to add probe results to the cache file '''
+    
+    cache_dict = _load_probe_cache()
+    cache_dict[cache_key] = [codec_str, ext]
+    _write_probe_cache(cache_dict)
+    
+    return
+
+# .....................................................................................................................
+
+def _remove_probe_cache_entry(cache_key):
+    
+    ''' Helper used to remove a (bad) result from the probe cache file, so that probing is re-run next time '''
+    
+    cache_dict = _load_probe_cache()
+    if cache_key in cache_dict:
+        del cache_dict[cache_key]
+        _write_probe_cache(cache_dict)
+    
+    return
+
+# .....................................................................................................................
+
+def _write_probe_cache(cache_dict):
+    
+    '''
+    Helper used to write probe results to the cache file. The file is replaced atomically,
+    so that other (simultaneously running) scripts never see a partially written file
+    '''
+    
+    try:
+        cache_folder = os.path.dirname(PROBE_CACHE_PATH)
+        os.makedirs(cache_folder, exist_ok = True)
+        temp_save_path = "{}.{}.tmp".format(PROBE_CACHE_PATH, os.getpid())
+        with open(temp_save_path, "w") as out_file:
+            json.dump(cache_dict, out_file, indent = 2)
+        os.replace(temp_save_path, PROBE_CACHE_PATH)
+        
+    except OSError:
+        # Not being able to cache results isn't a problem, we'll just have to probe again next time
+        pass
+    
+    return
+
+
 #%% Demo
 
 if __name__ == "__main__":
-    pass
+    
+    print("", "Recording parameters:", "  {}".format(find_valid_recording_parameters()), sep = "\n")